@@ -12,16 +12,28 @@ and deleted, so the script doesn't waste your drive
 '''
 
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
-from random import shuffle
-from time import perf_counter as time
-from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import cached_property
+from time import perf_counter_ns as time_ns
+import errno
 import json
+import mmap
 import os
-import re
-import shutil
 import sys
 import tempfile
 
+import numpy as np
+
+try:
+    import liburing
+except ImportError:
+    liburing = None
+
+# sqe flag marking the fd field as an index into the registered file
+# table; the kernel ABI value, since the binding doesn't export it
+IOSQE_FIXED_FILE = 1 << 0
+
 ASCIIART = r'''Brought to you by coding monkeys.
 Eat bananas, drink coffee & enjoy!
                  _
@@ -47,15 +59,34 @@ Eat bananas, drink coffee & enjoy!
 
 
 def str_to_bytes(size):
-    units = {'B': 1, 'KB': 2**10, 'MB': 2**20, 'GB': 2**30, 'TB': 2**40}
+    # longest suffixes first so 'KB' isn't mistaken for a bare 'B'
+    units = {'TB': 2**40, 'GB': 2**30, 'MB': 2**20, 'KB': 2**10, 'B': 1}
+    size = size.strip().upper()
+    multiplier = 1
+    for suffix, mul in units.items():
+        if size.endswith(suffix):
+            size = size[:-len(suffix)]
+            multiplier = mul
+            break
     try:
-        number, unit = re.match(r'^(\d+(?:\.\d+)?)\s?([KMGT]?B)?',
-                                size.upper()).groups()
-        return int(float(number) * units.get(unit, 'B'))
-    except AttributeError:
+        return int(float(size) * multiplier)
+    except ValueError:
         return None
 
 
+@contextmanager
+def opened(path, flags):
+    '''
+    Context-managed os.open, so the fd is closed even when a test
+    dies mid-loop (SIGINT, ENOSPC) and can't leak into later runs.
+    '''
+    f = os.open(path, flags=flags)
+    try:
+        yield f
+    finally:
+        os.close(f)
+
+
 def get_args():
     common_params = {
         'required': False,
@@ -85,6 +116,14 @@ def get_args():
     parser.add_argument('-j', '--json',
                         help='Output to json file',
                         **common_params)
+    parser.add_argument('-c', '--cold',
+                        action='store_true',
+                        help='Drop the cached file data before reading')
+    parser.add_argument('-t', '--threads',
+                        type=int,
+                        default=os.cpu_count(),
+                        help='Concurrent reader threads for the pread path',
+                        **common_params)
     args = parser.parse_args()
 
     if not os.path.isdir(args.path):
@@ -95,10 +134,39 @@ def get_args():
 
 class Benchmark:
 
-    def __init__(self, path, size, write_block, read_block=None):
+    # blocks submitted per os.writev call; keeps Python/syscall overhead
+    # out of the timed loop for small block sizes (IOV_MAX is 1024)
+    WRITE_BATCH = 64
+    # in-flight requests per io_uring submission; keeps the device queue
+    # full instead of exposing only single-request latency
+    QUEUE_DEPTH = 32
+    # mapping the file pays a setup cost, so the mmap read path is only
+    # worth it once the file is big enough to amortize it
+    MMAP_THRESHOLD = 10 * 2 ** 20
+
+    def __init__(self, path, size, write_block, read_block=None, cold=False,
+                 threads=None):
         self.path = os.path.abspath(path)
         _, self.file = tempfile.mkstemp(dir=self.path)
         self.size = size
+        self.cold = cold
+        self.threads = threads or os.cpu_count() or 1
+        # wall time of the threaded read pool; stays None on the
+        # single-threaded paths, where summed latencies already are
+        # wall time
+        self.read_wall = None
+
+        self.ring = None
+        if liburing is not None:
+            try:
+                ring = liburing.io_uring()
+                liburing.io_uring_queue_init(256, ring, 0)
+            except OSError:
+                # kernel or container without io_uring support; the
+                # synchronous paths still work
+                pass
+            else:
+                self.ring = ring
 
         if not read_block:
             read_block = write_block
@@ -117,43 +185,163 @@ class Benchmark:
 
     @staticmethod
     def convert_results(result, ndigits=2):
-        return round(result / 1024 ** 2, ndigits)
+        # float() keeps numpy scalars out of the results dict, which
+        # json.dump can't serialize
+        return round(float(result) / 1024 ** 2, ndigits)
 
     @staticmethod
-    def force_cache_drop():
-        with open('/proc/sys/vm/drop_caches', 'w') as c:
-            c.write('1')
+    def check_cqe(cqe):
+        # failed I/O surfaces in the completion (e.g. O_DIRECT EINVAL
+        # is reported here, not at open time); recording it as a fast
+        # successful block would corrupt the stats
+        if cqe.res < 0:
+            raise OSError(-cqe.res, os.strerror(-cqe.res))
+
+    @staticmethod
+    def coalesce_offsets(offsets, block_size, max_run):
+        '''
+        Collapses runs of adjacent offsets into (offset, blocks) pairs
+        so each run can be read with a single vectored call. After a
+        shuffle only ~1/n of the offsets are adjacent; the pairs mainly
+        feed the batched submission paths.
+        '''
+        runs = []
+        i = 0
+        n = len(offsets)
+        while i < n:
+            run = 1
+            while (i + run < n and run < max_run
+                   and offsets[i + run] == offsets[i + run - 1] + block_size):
+                run += 1
+            runs.append((int(offsets[i]), run))
+            i += run
+        return runs
 
     def run(self):
-        wr_blocks, rd_blocks = map(lambda x: int(self.size / x),
-                                   (self.write_block, self.read_block))
+        # O_DIRECT needs page-multiple blocks; round the write block up
+        # front, before blocks_count is derived, so the reported write
+        # stats describe the block size actually issued
+        self.write_block = (-(-self.write_block // mmap.PAGESIZE)
+                            * mmap.PAGESIZE)
+        wr_blocks = max(1, int(self.size / self.write_block))
         self.write_results = self.write_test(self.write_block, wr_blocks)
+
+        # wr_blocks truncates, so the file can hold less than
+        # self.size; clamp the read block to what was written, or a
+        # block bigger than the file would leave nothing to read
+        file_size = os.path.getsize(self.file)
+        self.read_block = min(self.read_block, file_size)
+        rd_blocks = max(1, int(file_size / self.read_block))
         self.read_results = self.read_test(self.read_block, rd_blocks)
 
+        if self.ring is not None:
+            liburing.io_uring_queue_exit(self.ring)
+
         return True
 
     def write_test(self, block_size, blocks_count, show_progress=True):
         '''
         Tests write speed by writing random blocks, at total quantity
         of blocks_count, each at size of block_size bytes to disk.
+        Blocks are submitted in batches of WRITE_BATCH per os.writev
+        call and the elapsed time is divided evenly across the batch.
+        Writes go through O_DIRECT so the device is measured instead of
+        the page cache, falling back to buffered I/O where unsupported;
+        block_size must be a multiple of the page size (run() rounds
+        the configured block up before calling).
         Function returns a list of write times in sec of each block.
         '''
-        f = os.open(self.file,
-                    flags=os.O_CREAT | os.O_WRONLY | os.O_SYNC)  # low-level I/O
-
-        took = []
-        for i in range(blocks_count):
-            if show_progress:
-                print('Writing: {:.2f} %'.format((i + 1) * 100 / blocks_count),
-                      end='\r', file=sys.stderr)
-            buff = bytearray(block_size)
-            start = time()
-            os.write(f, buff)
-            t = time() - start
-            took.append(t)
+        flags = os.O_CREAT | os.O_WRONLY | os.O_DIRECT
+        try:
+            os.close(os.open(self.file, flags=flags))
+        except OSError as e:
+            if e.errno != errno.EINVAL:
+                raise
+            print('O_DIRECT is not supported here, writes will be buffered',
+                  file=sys.stderr)
+            flags = os.O_CREAT | os.O_WRONLY | os.O_SYNC
+
+        # an anonymous mmap is page-aligned as O_DIRECT requires
+        # (bytearray gives no such guarantee); filled once with random
+        # data so compressing filesystems can't short-circuit all-zero
+        # blocks, then reused for every write
+        buff = mmap.mmap(-1, block_size)
+        buff[:] = os.urandom(block_size)
+        with opened(self.file, flags) as f:
+            if self.ring is not None:
+                took = self._write_test_uring(f, buff, block_size,
+                                              blocks_count, show_progress)
+            else:
+                took = np.empty(blocks_count, np.int64)
+                written = 0
+                progress_every = max(1, blocks_count // 100)
+                shown = 0
+                while written < blocks_count:
+                    if show_progress and written >= shown:
+                        print('Writing: {:.2f} %'.format(
+                                  written * 100 / blocks_count),
+                              end='\r', file=sys.stderr)
+                        shown += progress_every
+                    # the same buffer is reused for every segment since
+                    # the writes are independent of each other
+                    iov = [buff] * min(self.WRITE_BATCH,
+                                       blocks_count - written)
+                    start = time_ns()
+                    os.writev(f, iov)
+                    t = time_ns() - start
+                    took[written:written + len(iov)] = t // len(iov)
+                    written += len(iov)
 
-        os.close(f)
         self.clear_line()
+        # nanosecond ints are stored in the hot loop; convert to
+        # seconds once here
+        return took.astype(np.float64) * 1e-9
+
+    def _write_test_uring(self, f, buff, block_size, blocks_count,
+                          show_progress):
+        '''
+        io_uring write path: keeps up to QUEUE_DEPTH writes in flight
+        and divides each batch's wall time evenly across its blocks,
+        like the writev path - overlapping in-flight completions can't
+        be timed individually without overcounting. The fd is
+        registered with the ring once, so the kernel skips the
+        per-submission file table lookup. The buffer stays
+        unregistered: liburing 2024.5.3 only builds fixed-write
+        requests from bytes-like buffers, which can't satisfy
+        O_DIRECT's page alignment (the write would EINVAL in the CQE).
+        '''
+        took = np.empty(blocks_count, np.int64)
+        cqe = liburing.io_uring_cqe()
+        liburing.io_uring_register_files(self.ring, [f])
+        done = 0
+        offset = 0
+        progress_every = max(1, blocks_count // 100)
+        shown = 0
+        while done < blocks_count:
+            if show_progress and done >= shown:
+                print('Writing: {:.2f} %'.format(done * 100 / blocks_count),
+                      end='\r', file=sys.stderr)
+                shown += progress_every
+            depth = min(self.QUEUE_DEPTH, blocks_count - done)
+            for n in range(depth):
+                sqe = liburing.io_uring_get_sqe(self.ring)
+                # fd 0 is the index into the registered file table,
+                # not a real descriptor
+                liburing.io_uring_prep_write(sqe, 0, buff, block_size,
+                                             offset)
+                sqe.flags |= IOSQE_FIXED_FILE
+                offset += block_size
+            start = time_ns()
+            liburing.io_uring_submit(self.ring)
+            for _ in range(depth):
+                liburing.io_uring_wait_cqe(self.ring, cqe)
+                self.check_cqe(cqe)
+                liburing.io_uring_cqe_seen(self.ring, cqe)
+            t = time_ns() - start
+            took[done:done + depth] = t // depth
+            done += depth
+        # the read test registers nothing, so leave the ring clean
+        liburing.io_uring_unregister_files(self.ring)
         return took
 
     def read_test(self, block_size, blocks_count,
@@ -164,46 +352,199 @@ class Benchmark:
         bytes until the End Of File reached.
         Returns a list of read times in sec of each block.
         '''
-        flags = os.O_RDONLY
-        if not self.is_tmpfs:
-            flags |= os.O_DIRECT
-        f = os.open(self.file, flags=flags)  # low-level I/O
-        offsets = list(range(0, blocks_count * block_size, block_size))
+        offsets = np.arange(blocks_count, dtype=np.int64) * block_size
+
+        # drop offsets past the end of the file up front: in a shuffled
+        # order the first past-EOF read would otherwise cut the test
+        # short and discard every remaining in-range sample
+        file_size = os.path.getsize(self.file)
+        offsets = offsets[offsets + block_size <= file_size]
+        blocks_count = len(offsets)
 
         # generate random read positions
         if randomize:
-            shuffle(offsets)
+            np.random.shuffle(offsets)
+
+        # reads stay buffered on purpose: unlike the write path,
+        # readahead and the page cache are part of what's measured here
+        with opened(self.file, os.O_RDONLY) as f:
+            if self.cold and not self.is_tmpfs:
+                # evict only this file's pages; unlike writing to
+                # /proc/sys/vm/drop_caches this needs no root and
+                # leaves the rest of the host's cache alone
+                os.posix_fadvise(f, 0, blocks_count * block_size,
+                                 os.POSIX_FADV_DONTNEED)
+
+            if (block_size < mmap.PAGESIZE
+                    and self.size >= self.MMAP_THRESHOLD):
+                # sub-page blocks are dominated by syscall overhead;
+                # copy them out of a mapping instead
+                took = self._read_test_mmap(f, block_size, offsets,
+                                            show_progress)
+            else:
+                # adjacent offsets (rare after a shuffle) are read with
+                # one vectored call instead of one call per block
+                runs = self.coalesce_offsets(offsets, block_size,
+                                             self.QUEUE_DEPTH)
+
+                if self.ring is not None:
+                    took = self._read_test_uring(f, block_size, runs,
+                                                 blocks_count,
+                                                 show_progress)
+                elif self.threads > 1:
+                    took = self._read_test_threads(block_size, runs,
+                                                   show_progress)
+                else:
+                    took = self._read_test_pread(f, block_size, runs,
+                                                 blocks_count,
+                                                 show_progress)
 
-        self.force_cache_drop()
+        self.clear_line()
+        # nanosecond ints are stored in the hot loop; convert to
+        # seconds once here
+        return took.astype(np.float64) * 1e-9
 
-        took = []
-        for i, offset in enumerate(offsets, 1):
-            if show_progress:
-                print('Reading: {:.2f} %'.format(i * 100 / blocks_count),
+    def _read_test_pread(self, f, block_size, runs, blocks_count,
+                         show_progress):
+        '''
+        Synchronous read path: one pread per block, or one preadv per
+        coalesced run of adjacent blocks.
+        '''
+        bufs = [bytearray(block_size) for _ in range(self.QUEUE_DEPTH)]
+        took = np.empty(blocks_count, np.int64)
+        done = 0
+        progress_every = max(1, blocks_count // 100)
+        shown = 0
+        for offset, count in runs:
+            if show_progress and done >= shown:
+                print('Reading: {:.2f} %'.format(done * 100 / blocks_count),
                       end='\r', file=sys.stderr)
-            start = time()
-            buff = os.pread(f, block_size, offset)  # read from position
-            t = time() - start
-            took.append(t)
+                shown += progress_every
+            start = time_ns()
+            if count == 1:
+                buff = os.pread(f, block_size, offset)  # read from position
+            else:
+                os.preadv(f, bufs[:count], offset)
+            t = time_ns() - start
+            if count == 1 and not buff:
+                # shouldn't happen now that offsets are clamped to the
+                # file size, but an unexpected EOF must not leave
+                # uninitialized slots in the stats
+                return took[:done]
+            took[done:done + count] = t // count
+            done += count
+        return took
 
-        os.close(f)
-        self.clear_line()
+    def _read_test_threads(self, block_size, runs, show_progress):
+        '''
+        Threaded read path: os.pread releases the GIL, so a pool of
+        workers keeps several requests in the device queue without
+        io_uring. Each worker opens its own fd and times its own
+        contiguous share of the runs; the per-op latencies only feed
+        the min/max stats, while read_time/read_speed come from the
+        pool's wall time (overlapping waits would otherwise sum to
+        more than the elapsed time).
+        '''
+        if show_progress:
+            print('Reading with {} threads...'.format(self.threads),
+                  end='\r', file=sys.stderr)
+        chunk = -(-len(runs) // self.threads)
+        parts = [runs[i:i + chunk] for i in range(0, len(runs), chunk)]
+        start = time_ns()
+        with ThreadPoolExecutor(max_workers=len(parts)) as pool:
+            futures = [pool.submit(self._read_test_worker, block_size, part)
+                       for part in parts]
+            took = np.concatenate([future.result() for future in futures])
+        self.read_wall = (time_ns() - start) * 1e-9
         return took
 
-    @property
+    def _read_test_worker(self, block_size, runs):
+        blocks = sum(count for _, count in runs)
+        with opened(self.file, os.O_RDONLY) as f:
+            return self._read_test_pread(f, block_size, runs, blocks,
+                                         show_progress=False)
+
+    def _read_test_mmap(self, f, block_size, offsets, show_progress):
+        '''
+        mmap read path: copies each block out of a read-only mapping
+        of the file, avoiding one syscall plus kernel crossing per
+        block; used for blocks smaller than a page.
+        '''
+        blocks_count = len(offsets)
+        took = np.empty(blocks_count, np.int64)
+        progress_every = max(1, blocks_count // 100)
+        shown = 0
+        with mmap.mmap(f, 0, prot=mmap.PROT_READ) as m:
+            for i in range(blocks_count):
+                if show_progress and i >= shown:
+                    print('Reading: {:.2f} %'.format(
+                              i * 100 / blocks_count),
+                          end='\r', file=sys.stderr)
+                    shown += progress_every
+                offset = offsets[i]
+                start = time_ns()
+                buff = m[offset:offset + block_size]
+                took[i] = time_ns() - start
+        return took
+
+    def _read_test_uring(self, f, block_size, runs, blocks_count,
+                         show_progress):
+        '''
+        io_uring read path: submits up to QUEUE_DEPTH coalesced runs
+        per batch, each as a vectored read into its own buffers, and
+        divides each batch's wall time evenly across its blocks, like
+        the writev path.
+        '''
+        took = np.empty(blocks_count, np.int64)
+        cqe = liburing.io_uring_cqe()
+        done = 0
+        i = 0
+        progress_every = max(1, blocks_count // 100)
+        shown = 0
+        while i < len(runs):
+            if show_progress and done >= shown:
+                print('Reading: {:.2f} %'.format(done * 100 / blocks_count),
+                      end='\r', file=sys.stderr)
+                shown += progress_every
+            batch = runs[i:i + self.QUEUE_DEPTH]
+            blocks = sum(count for _, count in batch)
+            iovs = []  # keeps the buffers alive until completion
+            for offset, count in batch:
+                sqe = liburing.io_uring_get_sqe(self.ring)
+                iov = liburing.iovec(
+                    [bytearray(block_size) for _ in range(count)])
+                iovs.append(iov)
+                liburing.io_uring_prep_readv(sqe, f, iov, offset)
+            start = time_ns()
+            liburing.io_uring_submit(self.ring)
+            for _ in range(len(batch)):
+                liburing.io_uring_wait_cqe(self.ring, cqe)
+                self.check_cqe(cqe)
+                liburing.io_uring_cqe_seen(self.ring, cqe)
+            t = time_ns() - start
+            took[done:done + blocks] = t // blocks
+            done += blocks
+            i += len(batch)
+        return took
+
+    @cached_property
     def results(self):
+        # cached so print_result and get_json_result don't each rerun
+        # the reductions over the per-block timings
+        read_time = (self.read_wall if self.read_wall is not None
+                     else float(self.read_results.sum()))
         return {
             'written_mb': self.convert_results(self.size, 0),
-            'write_time': round(sum(self.write_results), 4),
-            'write_speed': self.convert_results(self.size / sum(self.write_results)),
-            'write_speed_min': self.convert_results(self.write_block / max(self.write_results)),
-            'write_speed_max': self.convert_results(self.write_block / min(self.write_results)),
+            'write_time': round(float(self.write_results.sum()), 4),
+            'write_speed': self.convert_results(self.size / self.write_results.sum()),
+            'write_speed_min': self.convert_results(self.write_block / self.write_results.max()),
+            'write_speed_max': self.convert_results(self.write_block / self.write_results.min()),
             'read_blocks': len(self.read_results),
             'block_size': self.read_block,
-            'read_time': round(sum(self.read_results), 4),
-            'read_speed': self.convert_results(self.size / sum(self.read_results)),
-            'read_speed_max': self.convert_results(self.read_block / min(self.read_results)),
-            'read_speed_min': self.convert_results(self.read_block / max(self.read_results))
+            'read_time': round(read_time, 4),
+            'read_speed': self.convert_results(len(self.read_results) * self.read_block / read_time),
+            'read_speed_max': self.convert_results(self.read_block / self.read_results.min()),
+            'read_speed_min': self.convert_results(self.read_block / self.read_results.max())
         }
 
     def print_result(self):
@@ -224,21 +565,14 @@ class Benchmark:
 
 
 def main():
-    if os.geteuid() != 0:
-        sudo_path = shutil.which('sudo')
-        print(f'Script must run as root. Relaunching with {sudo_path}',
-              file=sys.stderr)
-        os.execl(sudo_path,
-                 sys.executable,
-                 os.path.abspath(sys.argv[0]),
-                 *sys.argv[1:])
-
     try:
         args = get_args()
         benchmark = Benchmark(path=args.path,
                               size=args.size,
                               write_block=args.write_block_size,
-                              read_block=args.read_block_size)
+                              read_block=args.read_block_size,
+                              cold=args.cold,
+                              threads=args.threads)
         benchmark.run()
 
         if args.json is not None:
@@ -256,7 +590,10 @@ def main():
             print('Could not remove {}'.format(args.file))
             sys.exit(os.EX_NOPERM)
         except UnboundLocalError:
-            sys.exit(os.EX_OSFILE)
+            # Benchmark was never constructed, so there is no file to
+            # remove; let whatever raised propagate instead of hiding
+            # it behind an exit code
+            pass
 
 
 if __name__ == '__main__':